@@ -6,12 +6,15 @@ import torchvision.transforms as transforms
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributed.device_mesh import init_device_mesh
-from torch.distributed._composable.fsdp import fully_shard
+from torch.distributed._composable.fsdp import fully_shard, MixedPrecisionPolicy
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import checkpoint_wrapper, CheckpointImpl
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 from fsdp_optimizers import SOAP, Kron, Muon, KronMars
 
 debug = False
 optimizer = "kron_mars"
+low_precision_optimizer_state = False  # bf16 momentum/preconditioners, only kron supports this
 optimizers = {
     "kron": Kron,
     "soap": SOAP,
@@ -19,6 +22,9 @@ optimizers = {
     "kron_mars": KronMars,
 }
 optimizer_class = optimizers[optimizer]
+if low_precision_optimizer_state and optimizer != "kron":
+    raise ValueError(f"low_precision_optimizer_state is only supported for kron, not {optimizer}")
+optimizer_kwargs = dict(mu_dtype=torch.bfloat16, precond_dtype=torch.bfloat16) if low_precision_optimizer_state else {}
 
 def print_if_master(*args):
     if torch.distributed.get_rank() == 0 and debug:
@@ -30,6 +36,11 @@ torch.distributed.init_process_group(
 )
 torch.cuda.set_device(torch.distributed.get_rank())
 
+# anything left in fp32 outside autocast gets tf32 tensor cores
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
 
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
@@ -37,14 +48,15 @@ class PreNorm(nn.Module):
         self.norm = nn.LayerNorm(dim)
         self.fn = fn
     def forward(self, x, **kwargs):
-        return self.fn(self.norm(x), **kwargs)
+        x = F.layer_norm(x, self.norm.normalized_shape, self.norm.weight, self.norm.bias, self.norm.eps)
+        return self.fn(x, **kwargs)
 
 class FeedForward(nn.Module):
     def __init__(self, dim, hidden_dim, dropout = 0.):
         super().__init__()
         self.net = nn.Sequential(
             nn.Linear(dim, hidden_dim),
-            nn.GELU(),
+            nn.GELU(approximate = 'tanh'),
             nn.Dropout(dropout),
             nn.Linear(hidden_dim, dim),
             nn.Dropout(dropout)
@@ -59,9 +71,8 @@ class Attention(nn.Module):
         project_out = not (heads == 1 and dim_head == dim)
 
         self.heads = heads
-        self.scale = dim_head ** -0.5
+        self.dropout_p = dropout
 
-        self.attend = nn.Softmax(dim = -1)
         self.to_qkv = nn.Linear(dim, inner_dim * 3, bias = False)
 
         self.to_out = nn.Sequential(
@@ -70,14 +81,11 @@ class Attention(nn.Module):
         ) if project_out else nn.Identity()
 
     def forward(self, x):
-        qkv = self.to_qkv(x).chunk(3, dim = -1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = self.heads), qkv)
-
-        dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
-
-        attn = self.attend(dots)
+        b, n, _ = x.shape
+        qkv = self.to_qkv(x).reshape(b, n, 3, self.heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
 
-        out = torch.matmul(attn, v)
+        out = F.scaled_dot_product_attention(q, k, v, dropout_p = self.dropout_p if self.training else 0., is_causal = False)
         out = rearrange(out, 'b h n d -> b n (h d)')
         return self.to_out(out)
 
@@ -105,13 +113,15 @@ class AttnPooler(nn.Module):
         super().__init__()
         self.to_k = torch.nn.Linear(dim, dim)
         self.to_v = torch.nn.Linear(dim, dim)
-        self.q = torch.nn.Parameter(torch.randn(1, 1, dim))
+        self.q = torch.nn.Parameter(torch.randn(1, dim))
 
     def forward(self, x):
         k = self.to_k(x)
         v = self.to_v(x)
-        q = self.q.expand(x.shape[0], -1, -1)
-        out = F.scaled_dot_product_attention(q, k, v).squeeze(1)
+        # a single query doesn't need the full attention kernel, just a softmax-weighted sum
+        scores = (k @ self.q.t()).squeeze(-1) * (k.shape[-1] ** -0.5)
+        weights = scores.softmax(-1).unsqueeze(-1)
+        out = (weights * v).sum(1)
         return out
 
 class PatchEmbed(nn.Module):
@@ -135,13 +145,19 @@ class PatchEmbed(nn.Module):
 
         self.pre_norm = torch.nn.LayerNorm(patch_dim) if pre_norm else torch.nn.Identity()
         self.post_norm = torch.nn.LayerNorm(out_dim) if post_norm else torch.nn.Identity()
-        self.proj = torch.nn.Linear(patch_dim, out_dim, bias=bias)
-
-    def forward(self, x):
-        x = rearrange(x, "b c (h p1) (w p2) -> b (h w) (p1 p2 c)", p1=self.patch_height, p2=self.patch_width)
-        x = self.pre_norm(x)
-        x = self.proj(x)
+        self.proj = torch.nn.Conv2d(channels, out_dim, kernel_size=patch_size, stride=patch_size, bias=bias)
+
+    def forward(self, x, pos=None):
+        if isinstance(self.pre_norm, torch.nn.Identity):
+            x = self.proj(x).flatten(2).transpose(1, 2)
+        else:
+            # norm needs unrolled patches, so apply the conv weight as a linear over them
+            x = rearrange(x, "b c (h p1) (w p2) -> b (h w) (c p1 p2)", p1=self.patch_height, p2=self.patch_width)
+            x = self.pre_norm(x)
+            x = F.linear(x, self.proj.weight.flatten(1), self.proj.bias)
         x = self.post_norm(x)
+        if pos is not None:
+            x = x + pos
         return x
 
 class VIT(nn.Module):
@@ -182,8 +198,7 @@ class VIT(nn.Module):
         self.proj_out = torch.nn.Linear(dim, num_classes)
 
     def forward(self, pixel_values):
-        x = self.patch_embed(pixel_values)
-        h = x + self.pos_embs.unsqueeze(0)
+        h = self.patch_embed(pixel_values, pos=self.pos_embs)
         h = self.transformer(h)
         h = self.out_norm(h)
         h = self.pooler(h)
@@ -205,8 +220,12 @@ if torch.distributed.get_rank() == 0:
 torch.distributed.barrier()
 trainset = torchvision.datasets.CIFAR10(root='./data', train=True,
                                         download=True, transform=transform)
-trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size,
-                                        shuffle=True, num_workers=8)
+# each rank trains on its own shard of the dataset
+train_sampler = DistributedSampler(trainset, num_replicas=torch.distributed.get_world_size(),
+                                   rank=torch.distributed.get_rank(), shuffle=True, drop_last=True)
+trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, sampler=train_sampler,
+                                        shuffle=False, drop_last=True, num_workers=8, pin_memory=True,
+                                        persistent_workers=True, prefetch_factor=4)
 
 if torch.distributed.get_rank() == 0:
     testset = torchvision.datasets.CIFAR10(root='./data', train=False,
@@ -215,7 +234,8 @@ torch.distributed.barrier()
 testset = torchvision.datasets.CIFAR10(root='./data', train=False,
                                     download=True, transform=transform)
 testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
-                                        shuffle=False, num_workers=8)
+                                        shuffle=False, num_workers=8, pin_memory=True,
+                                        persistent_workers=True, prefetch_factor=4)
 
 classes = ('plane', 'car', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck')
 
@@ -226,8 +246,15 @@ device_mesh = init_device_mesh("cuda", (8,), mesh_dim_names=("dp",))
 fsdp_config = {
     "mesh": device_mesh,
     "reshard_after_forward": True,
+    "mp_policy": MixedPrecisionPolicy(param_dtype=torch.bfloat16, reduce_dtype=torch.float32),
 }
 
+# checkpoint inside the shard, i.e. fully_shard(checkpoint_wrapper(block))
+for i, attn in enumerate(net.transformer.attentions):
+    net.transformer.attentions[i] = checkpoint_wrapper(attn, checkpoint_impl=CheckpointImpl.NO_REENTRANT)
+for i, ffn in enumerate(net.transformer.ffns):
+    net.transformer.ffns[i] = checkpoint_wrapper(ffn, checkpoint_impl=CheckpointImpl.NO_REENTRANT)
+
 for attn in net.transformer.attentions:
     print_if_master("Sharding attention")
     fully_shard(attn, **fsdp_config)
@@ -237,40 +264,62 @@ for ffn in net.transformer.ffns:
 print_if_master("Sharding transformer")
 fully_shard(net, **fsdp_config)
 
+# blocks run attn0, ffn0, attn1, ffn1, ... so prefetch the neighbouring block's all-gather
+blocks = [block for pair in zip(net.transformer.attentions, net.transformer.ffns) for block in pair]
+for i, block in enumerate(blocks):
+    if i + 1 < len(blocks):
+        block.set_modules_to_forward_prefetch([blocks[i + 1]])
+    if i > 0:
+        block.set_modules_to_backward_prefetch([blocks[i - 1]])
+
+net = torch.compile(net, mode="max-autotune-no-cudagraphs")
+
 criterion = nn.CrossEntropyLoss()
-optimizer = optimizer_class(net.parameters(), lr=0.001)
+optimizer = optimizer_class(net.parameters(), lr=0.001, **optimizer_kwargs)
 
+# warm up once so the initial compile and autotuning happen before the loop
+warmup_inputs = torch.zeros(batch_size, 3, 32, 32, device="cuda").to(memory_format=torch.channels_last)
+warmup_labels = torch.zeros(batch_size, dtype=torch.long, device="cuda")
+with torch.amp.autocast("cuda", dtype=torch.bfloat16):
+    loss = criterion(net(warmup_inputs), warmup_labels)
+loss.backward()
+optimizer.zero_grad()
+print_if_master("compiled")
 
 pbar = tqdm(enumerate(trainloader), total=len(trainloader), disable=torch.distributed.get_rank() != 0)
 for epoch in range(2):  # loop over the dataset multiple times
-    running_loss = 0.0
+    train_sampler.set_epoch(epoch)
+    running_loss = torch.zeros((), device="cuda")
     for i, data in enumerate(trainloader, 0):
         # get the inputs; data is a list of [inputs, labels]
         inputs, labels = data
-        inputs = inputs.to("cuda")
-        labels = labels.to("cuda")
+        inputs = inputs.to("cuda", non_blocking=True)
+        inputs = inputs.to(memory_format=torch.channels_last)
+        labels = labels.to("cuda", non_blocking=True)
 
         # zero the parameter gradients
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         print_if_master("zeroed grad")
 
         # forward + backward + optimize
-        outputs = net(inputs)
-        print_if_master("got outputs")
-        loss = criterion(outputs, labels)
-        print_if_master("got loss")
+        with torch.amp.autocast("cuda", dtype=torch.bfloat16):
+            outputs = net(inputs)
+            print_if_master("got outputs")
+            loss = criterion(outputs, labels)
+            print_if_master("got loss")
         loss.backward()
         print_if_master("backprop'd")
         optimizer.step()
         print_if_master("stepped")
 
-        # print statistics
-        running_loss += loss.item()
+        # print statistics, keeping the loss on-device until it is printed
+        running_loss += loss.detach()
         if i % 2000 == 1999:    # print every 2000 mini-batches
-            print(f'[{epoch + 1}, {i + 1:5d}] loss: {running_loss / 2000:.3f}')
-            running_loss = 0.0
-        
+            print(f'[{epoch + 1}, {i + 1:5d}] loss: {running_loss.item() / 2000:.3f}')
+            running_loss.zero_()
+
         pbar.update(1)
-        pbar.set_description(f"Loss: {loss.item():.3f}")
+        if i % 50 == 0:
+            pbar.set_description(f"Loss: {loss.item():.3f}")
 
 print('Finished Training')